@@ -1,27 +1,31 @@
 #!/usr/bin/env python3
 
+import os
 import struct
 import sys
 from pprint import pprint as P
-from collections import OrderedDict
 import argparse
 import zlib
 import hashlib
 import random
+from itertools import chain, repeat
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce, lru_cache
+from operator import xor
 
 def md5(buf):
     h = hashlib.md5()
     h.update(buf)
     return h.hexdigest()
 
-def dump(buf):
+def dump(buf, verify_checksums=False):
     cab = CABFile(buf)
     cab.dump()
     print("\n\n\n")
 
     for i in range(len(cab.folders)):
         print("# Folder %d files"%i)
-        files = cab.get_folder_files(i)
+        files = cab.get_folder_files(i, verify_checksums)
         for (fn, data) in files:
             cksum = md5(data)
             if len(data) > 10:
@@ -74,6 +78,17 @@ def main():
 # d     double    float                    8
 # s     char[]    bytes
 
+# fixed-size prefixes of the CFHEADER, CFFOLDER, CFFILE and CDATA records
+_CFHEADER = struct.Struct('<4s4xI4xI4xBBHHHHH')
+_CFHEADER_NAMES = ('signature', 'cbCabinet', 'coffFiles', 'vMinor', 'vMajor',
+                   'cFolders', 'cFiles', 'flags', 'setID', 'iCabinet')
+_CFFOLDER = struct.Struct('<IHH')
+_CFFOLDER_NAMES = ('coffCabStart', 'cCFData', 'typeCompress')
+_CFFILE = struct.Struct('<IIHHHH')
+_CFFILE_NAMES = ('cbFile', 'uoffFolderStart', 'iFolder', 'date', 'time', 'attribs')
+_CFDATA = struct.Struct('<IHH')
+_CFDATA_NAMES = ('csum', 'cbData', 'cbUncomp')
+
 class CABFile:
     COMPRESSION_NONE    = 0
     COMPRESSION_MSZIP   = 1
@@ -85,22 +100,11 @@ class CABFile:
         self.f = Blob(buf)
         self.folders = []
         self.files = []
+        self.folder_files = {}
         self.datas = []
-        self.data_off = {}
-
-        self.f.parse('4s', 'signature')
-        self.f.parse('xxxx')
-        self.f.parse('<I', 'cbCabinet')
-        self.f.parse('xxxx')
-        self.f.parse('<I', 'coffFiles')
-        self.f.parse('xxxx')
-        self.f.parse('<B', 'vMinor')
-        self.f.parse('<B', 'vMajor')
-        self.f.parse('<H', 'cFolders')
-        self.f.parse('<H', 'cFiles')
-        self.f.parse('<H', 'flags')
-        self.f.parse('<H', 'setID')
-        self.f.parse('<H', 'iCabinet')
+        self.folder_first_data = []
+
+        self.f.parse_struct(_CFHEADER, _CFHEADER_NAMES)
         if self.f.data['flags'] & 0x0004 != 0:
             self.f.parse('<H', 'cbCFHeader')
             self.f.parse('<B', 'cbCFFolder')
@@ -120,36 +124,33 @@ class CABFile:
 
         for i in range(self.f.data['cFolders']):
             b = self.f.new_blob()
-            b.parse('<I', 'coffCabStart')
-            b.parse('<H', 'cCFData')
-            b.parse('<H', 'typeCompress')
+            b.parse_struct(_CFFOLDER, _CFFOLDER_NAMES)
             b.parse('%ds'%Fres, 'abReserve')
             self.folders.append(b)
             self.f.br.off += b.read_size()
 
         for i in range(self.f.data['cFiles']):
             b = self.f.new_blob()
-            b.parse('<I', 'cbFile')
-            b.parse('<I', 'uoffFolderStart')
-            b.parse('<H', 'iFolder')
-            b.parse('<H', 'date')
-            b.parse('<H', 'time')
-            b.parse('<H', 'attribs')
+            b.parse_struct(_CFFILE, _CFFILE_NAMES)
             b.parse_cstring('szName')
             self.files.append(b)
+            self.folder_files.setdefault(b.data['iFolder'], []).append(b)
             self.f.br.off += b.read_size()
 
+        data_idx = {}
         while self.f.br.off < len(self.f.br.buf):
             b = self.f.new_blob()
-            b.parse('<I', 'csum')
-            b.parse('<H', 'cbData')
-            b.parse('<H', 'cbUncomp')
+            b.parse_struct(_CFDATA, _CFDATA_NAMES)
             b.parse('%ds'%Dres, 'abReserve')
-            b.parse('%ds'%b.data['cbData'], 'ab')
+            b.parse_view(b.data['cbData'], 'ab')
+            data_idx[self.f.read_size()] = len(self.datas)
             self.datas.append(b)
-            self.data_off[self.f.read_size()] = b
             self.f.br.off += b.read_size()
 
+        # CDATA of a folder are consecutive, only remember the first one
+        for fol in self.folders:
+            self.folder_first_data.append(data_idx.get(fol.data['coffCabStart']))
+
     def dump(self):
         self.f.dump()
 
@@ -165,132 +166,171 @@ class CABFile:
             print("\n# DATA %d"%i)
             dat.dump()
 
-    def get_folder_files(self, index):
-        chunks = []
+    def verify(self):
+        for cdata in self.datas:
+            verify_cdata(cdata)
+
+    def iter_folder_files(self, index, verify_checksums=False):
         folder = self.folders[index]
-        cdata_off = folder.data['coffCabStart']
+        cdata_start = self.folder_first_data[index]
         cdata_nb = folder.data['cCFData']
         compress = folder.data['typeCompress']
 
         # get all CDATA belonging to that folder
 
-        for i in range(cdata_nb):
-            cdata = self.data_off[cdata_off]
-            raw = cdata.data['ab']
-
-            # checksum happens on whole CDATA block minus initial 4 bytes (csum itself)
-            csum = checksum(cdata.br.buf[4:cdata.read_size()])
-            assert(csum == cdata.data['csum'])
-
-            chunks.append(raw)
-            cdata_off += cdata.read_size()
-
+        cdatas = []
+        if cdata_nb > 0 and cdata_start is not None:
+            cdatas = self.datas[cdata_start:cdata_start+cdata_nb]
+        if len(cdatas) != cdata_nb:
+            raise struct.error("folder %d requires %d CDATA blocks (found %d)"%(index, cdata_nb, len(cdatas)))
+        if verify_checksums:
+            for cdata in cdatas:
+                verify_cdata(cdata)
 
         # concat them, apply eventual decompress step
 
         folder_data = None
         if compress == CABFile.COMPRESSION_NONE:
-            folder_data = b''.join(chunks)
+            if len(cdatas) == 1:
+                # single block: files are views on the cabinet buffer itself
+                folder_data = cdatas[0].data['ab']
+            else:
+                folder_data = bytearray(sum(len(c.data['ab']) for c in cdatas))
+                pos = 0
+                for c in cdatas:
+                    n = len(c.data['ab'])
+                    folder_data[pos:pos+n] = c.data['ab']
+                    pos += n
         elif compress == CABFile.COMPRESSION_MSZIP:
-            folder_data = decompress_mzip(chunks)
+            folder_data = decompress_mzip(cdatas)
         else:
             assert(False and "unsupported type")
 
         # split the folder data according to offsets set in CFILEs
 
-        files = []
-        for fi in self.files:
-            if fi.data['iFolder'] == index:
-                beg = fi.data['uoffFolderStart']
-                end = beg + fi.data['cbFile']
-                data = folder_data[beg:end]
-                files.append((fi.data['szName'], data))
+        folder_data = memoryview(folder_data)
+        for fi in self.folder_files.get(index, []):
+            beg = fi.data['uoffFolderStart']
+            end = beg + fi.data['cbFile']
+            yield (fi.data['szName'], folder_data[beg:end])
 
-        return files
+    def get_folder_files(self, index, verify_checksums=False):
+        return [(fn, bytes(data)) for (fn, data) in self.iter_folder_files(index, verify_checksums)]
 
-def decompress_mzip(chunks):
+def decompress_mzip(cdatas):
     # remove 'CK' bytes from each CDATA buffer
-    for x in chunks:
+    chunks = []
+    for cdata in cdatas:
+        x = cdata.data['ab']
         if not(x[0]==b'C'[0] and x[1]==b'K'[0]):
-            print("[!!] weird chunk <%s>"%x)
+            print("[!!] weird chunk <%s>"%bytes(x[:16]))
             exit(1)
+        chunks.append(memoryview(x)[2:])
 
-    chunks = [x[2:] for x in chunks]
-    output_chunks = []
-    zdict = b''
+    # uncompressed size of each block is known upfront
+    output = bytearray(sum(cdata.data['cbUncomp'] for cdata in cdatas))
+    mv = memoryview(output)
+    pos = 0
 
     for i, c in enumerate(chunks):
         print("decompress chunk %d"%i)
-        out = b''
         # https://blogs.kde.org/2008/01/04/kcabinet-mostly-working
-        z = zlib.decompressobj(wbits=-15, zdict=zdict)
+        # history window is the last 32KiB of output
+        z = zlib.decompressobj(wbits=-15, zdict=mv[max(0, pos-32768):pos])
         #out += zlib.decompress(c, 15)
-        out += z.decompress(c)
-        out += z.flush()
-        zdict = out
-        output_chunks.append(out)
+        out = z.decompress(c)
+        if not z.eof:
+            out += z.flush()
+        n = cdatas[i].data['cbUncomp']
+        if len(out) != n:
+            raise ValueError("bad uncompressed size for CDATA at offset %d (%d != %d)"%(cdatas[i].start_off, len(out), n))
+        mv[pos:pos+n] = out
+        pos += n
+
+    return output
+
+def checksum_cdata(cdata):
+    # checksum happens on whole CDATA block minus initial 4 bytes (csum itself)
+    return checksum(memoryview(cdata.br.buf)[cdata.start_off+4:cdata.br.off])
+
+def verify_cdata(cdata):
+    if checksum_cdata(cdata) != cdata.data['csum']:
+        raise ValueError("bad CDATA checksum at offset %d"%cdata.start_off)
 
-    return b''.join(output_chunks)
+_U32 = struct.Struct('<I')
+_U64 = struct.Struct('<Q')
 
 def checksum(buf, seed=0):
     size = len(buf)
     last = (size // 4)*4
-    # walk buf 4 bytes at a time to work on longs
-    for i in range(0, last, 4):
-        seed ^= ((buf[i+0]) | (buf[i+1]<<8) | (buf[i+2]<<16) | (buf[i+3]<<24))
-
-    # handle uncomplete long at the end
-    rest = size % 4
-    if rest == 1:
-        seed ^= buf[last]
-    if rest == 2:
-        seed ^= ((buf[last]<<8)|(buf[last+1]))
-    if rest == 3:
-        seed ^= ((buf[last]<<16)|(buf[last+1]<<8)|(buf[last+2]))
+    # xor is associative: walk buf 8 bytes at a time and fold the two
+    # little-endian longs of the accumulator together at the end
+    mv = memoryview(buf)
+    last8 = (size // 8)*8
+    acc = reduce(xor, chain.from_iterable(_U64.iter_unpack(mv[:last8])), 0)
+    seed ^= (acc ^ (acc >> 32)) & 0xffffffff
+    if last8 < last:
+        seed ^= _U32.unpack_from(mv, last8)[0]
+
+    # handle uncomplete long at the end (bytes are taken in reverse order)
+    if last < size:
+        seed ^= int.from_bytes(buf[last:], 'big')
 
     return seed
 
+@lru_cache(maxsize=64)
+def _S(fmt):
+    return struct.Struct(fmt)
+
 class BinReader:
+    __slots__ = ('buf', 'off')
+
     def __init__(self, buf, off=0):
         self.buf = buf
         self.off = off
 
     def read(self, fmt):
-        r = struct.unpack_from(fmt, self.buf, self.off)
-        self.off += struct.calcsize(fmt)
+        s = _S(fmt)
+        r = s.unpack_from(self.buf, self.off)
+        self.off += s.size
         return r
 
     def read_cstring(self):
-        s = b''
-        while True:
-            r = self.read('B')
-            if int(r[0]) == 0:
-                return (s,)
-            s += bytes(r)
+        # CAB strings are at most 256 bytes plus the terminating NUL
+        chunk = bytes(self.buf[self.off:self.off+257])
+        end = chunk.find(0)
+        if end < 0:
+            raise struct.error("unterminated string at offset %d"%self.off)
+        self.off += end + 1
+        return (chunk[:end],)
 
 class BinWriter:
     def __init__(self):
-        self.buf = bytearray(b'')
+        self.buf = bytearray()
         self.off = 0
 
     def write(self, fmt, *args):
-        self.buf += struct.pack(fmt, *args)
-        self.off = len(self.buf)
+        s = _S(fmt)
+        self.buf.extend(s.pack(*args))
+        self.off += s.size
 
     def write_at(self, off, fmt, *args):
-        struct.pack_into(fmt, self.buf, off, *args)
+        _S(fmt).pack_into(self.buf, off, *args)
 
     def append(self, buf):
-        self.buf += buf
+        self.buf.extend(buf)
         self.off = len(self.buf)
 
 class Blob:
-    def __init__(self, buf):
-        self.br = BinReader(buf)
-        self.data = OrderedDict({})
+    __slots__ = ('br', 'start_off', 'data')
+
+    def __init__(self, buf, off=0):
+        self.br = BinReader(buf, off)
+        self.start_off = off
+        self.data = {}
 
     def read_size(self):
-        return self.br.off
+        return self.br.off - self.start_off
 
     def parse(self, fmt, name=None):
         r = self.br.read(fmt)
@@ -298,6 +338,19 @@ class Blob:
             return
         self.data[name] = r[0]
 
+    def parse_struct(self, s, names):
+        r = s.unpack_from(self.br.buf, self.br.off)
+        self.br.off += s.size
+        self.data.update(zip(names, r))
+
+    def parse_view(self, size, name):
+        # zero-copy view on the underlying buffer
+        off = self.br.off
+        if off + size > len(self.br.buf):
+            raise struct.error("parse_view requires a buffer of at least %d bytes (actual buffer size is %d)"%(off+size, len(self.br.buf)))
+        self.data[name] = memoryview(self.br.buf)[off:off+size]
+        self.br.off += size
+
     def parse_cstring(self, name):
         r = self.br.read_cstring()
         if name is None:
@@ -305,53 +358,59 @@ class Blob:
         self.data[name] = r[0]
 
     def new_blob(self):
-        return Blob(self.br.buf[self.br.off:])
+        # share the buffer, only the starting offset differs
+        return Blob(self.br.buf, self.br.off)
 
     def dump(self):
         for k,v in self.data.items():
-            if type(v) in [str, bytes]:
+            if type(v) in [str, bytes, memoryview]:
+                s = v[0:30]
+                if type(v) is memoryview:
+                    s = bytes(s)
                 if len(v) > 30:
-                    v = '%s... (%d bytes)'%(v[0:30], len(v))
+                    s = '%s... (%d bytes)'%(s, len(v))
+                v = s
             print("%-20.20s %s"%(k, v))
 
 
+def make_cdata(chunk, zdict, compress=True):
+    if compress:
+        z = zlib.compressobj(wbits=-15, zdict=zdict)
+        c = [b'CK', z.compress(chunk), z.flush(zlib.Z_FINISH)]
+    else:
+        c = [chunk]
+
+    # write header and payload pieces straight into the final buffer
+    size = sum(len(x) for x in c)
+    output = bytearray(_CFDATA.size + size)
+    _CFDATA.pack_into(output, 0, 0, size, len(chunk))
+    off = _CFDATA.size
+    for x in c:
+        output[off:off+len(x)] = x
+        off += len(x)
+
+    # the cbData/cbUncomp long is the first one covered by the checksum:
+    # seed with it and only walk the payload, without copying it
+    csum = checksum(memoryview(output)[_CFDATA.size:], _U32.unpack_from(output, 4)[0])
+    _U32.pack_into(output, 0, csum)
+    return output
+
 def make_cdatas(data, compress=True):
-    start_off = 0
     max_chunk_size = 32768
-    data_size = len(data)
-    remaining = data_size
-    res = []
-    zdict = b''
-
-    while start_off < data_size:
-        output = BinWriter()
-
-        chunk_size = min(max_chunk_size, remaining)
-        chunk = data[start_off:start_off+chunk_size]
-
-        output.write('<I', 0)
-
-        if compress:
-            z = zlib.compressobj(wbits=-15, zdict=zdict)
-            c = b'CK'
-            c += z.compress(chunk)
-            c += z.flush(zlib.Z_FINISH)
-            #c += z.flush(zlib.Z_FULL_FLUSH)
-            #c += z.flush(zlib.Z_FINISH if chunk_size == remaining else zlib.Z_SYNC_FLUSH)
-            #c += z.flush(zlib.Z_FINISH if chunk_size == remaining else zlib.Z_FULL_FLUSH)
-        else:
-            c = chunk
-
-        output.write('<HH', len(c), len(chunk))
-        output.append(c)
-        csum = checksum(output.buf[4:])
-        print("csum = %d"%csum)
-        output.write_at(0, '<I', csum)
-        res.append(output.buf)
-
-        zdict = chunk
-        start_off += chunk_size
-        remaining -= chunk_size
+    mv = memoryview(data)
+    chunks = [mv[off:off+max_chunk_size] for off in range(0, len(data), max_chunk_size)]
+    # each block only depends on the raw bytes of the previous one,
+    # so they can all be compressed concurrently (zlib releases the GIL)
+    zdicts = [b''] + chunks[:-1]
+
+    if compress and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            res = list(ex.map(make_cdata, chunks, zdicts, repeat(compress)))
+    else:
+        res = list(map(make_cdata, chunks, zdicts, repeat(compress)))
+
+    for output in res:
+        print("csum = %d"%_U32.unpack_from(output, 0)[0])
 
     return res
 